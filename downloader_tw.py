@@ -1,34 +1,31 @@
 # -*- coding: utf-8 -*-
-import os, io, time, random, sqlite3, requests
+import os, time
 import pandas as pd
-import yfinance as yf
 from io import StringIO
 from datetime import datetime
-from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from warehouse_core import (
+    log, SESSION, close_conn, init_db, sync_prices, text_column, load_cached_list,
+    save_stock_list,
+)
 
 # ========== 1. 環境設定 ==========
 MARKET_CODE = "tw-share"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "tw_stock_warehouse.db")
+# 💡 完整 VACUUM 會重寫整個 DB，只在設定 FULL_VACUUM=1 時執行 (例如每月一次)
+FULL_VACUUM = os.environ.get("FULL_VACUUM") == "1"
+# 熱/冷模式的預設起始日 (main.py 傳入 start_date 時以其為準)
+HOT_START_DATE = "2023-01-01"
+COLD_START_DATE = "1993-01-04"
 
-def log(msg: str):
-    print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}", flush=True)
-
-# ========== 2. 資料庫初始化 ==========
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        conn.execute('''CREATE TABLE IF NOT EXISTS stock_prices (
-                            date TEXT, symbol TEXT, open REAL, high REAL, 
-                            low REAL, close REAL, volume INTEGER,
-                            PRIMARY KEY (date, symbol))''')
-        conn.execute('''CREATE TABLE IF NOT EXISTS stock_info (
-                            symbol TEXT PRIMARY KEY, name TEXT, sector TEXT, market TEXT, updated_at TEXT)''')
-    finally:
-        conn.close()
-
-# ========== 3. 獲取台股清單 (完整網址，過濾邏輯) ==========
+# ========== 2. 獲取台股清單 (完整網址，過濾邏輯) ==========
 def get_tw_stock_list():
+    cached = load_cached_list(DB_PATH)
+    if cached:
+        log(f"♻️ 今日已同步過清單，沿用資料庫既有清單: {len(cached)} 檔")
+        return cached
+
     url_configs = [
     {'name': 'listed', 'url': 'https://isin.twse.com.tw/isin/class_main.jsp?market=1&issuetype=1&Page=1&chklike=Y', 'suffix': '.TW'},
     {'name': 'dr', 'url': 'https://isin.twse.com.tw/isin/class_main.jsp?owncode=&stockname=&isincode=&market=1&issuetype=J&industry_code=&Page=1&chklike=Y', 'suffix': '.TW'},
@@ -41,65 +38,60 @@ def get_tw_stock_list():
 
     
     log(f"📡 獲取台股清單 (自動跳過權證分類)...")
-    conn = sqlite3.connect(DB_PATH)
-    stock_list = []
+    frames = []
+    today_str = datetime.now().strftime("%Y-%m-%d")
     
+    # 💡 核心過濾：如果名稱包含 'warrant'，直接跳過不解析、不存入資料庫
+    configs = []
     for cfg in url_configs:
-        # 💡 核心過濾：如果名稱包含 'warrant'，直接跳過不解析、不存入資料庫
         if 'warrant' in cfg['name']:
             log(f"⏭️  跳過分類: {cfg['name']}")
-            continue
-            
+        else:
+            configs.append(cfg)
+
+    def _fetch_page(cfg):
+        resp = SESSION.get(cfg['url'], timeout=15)
+        return pd.read_html(StringIO(resp.text), header=0)
+
+    # 💡 各分類頁同時下載 (網路等待重疊)，解析結果仍依原順序合併
+    with ThreadPoolExecutor(max_workers=len(configs) or 1) as executor:
+        pages = [(cfg, executor.submit(_fetch_page, cfg)) for cfg in configs]
+
+    for cfg, future in pages:
         try:
-            resp = requests.get(cfg['url'], timeout=15)
-            dfs = pd.read_html(StringIO(resp.text), header=0)
+            dfs = future.result()
             if not dfs: continue
             df = dfs[0]
             
-            for _, row in df.iterrows():
-                code = str(row['有價證券代號']).strip()
-                name = str(row['有價證券名稱']).strip()
-                sector = str(row.get('產業別', 'Unknown')).strip()
-                
-                if code.isalnum() and len(code) >= 4:
-                    symbol = f"{code}{cfg['suffix']}"
-                    conn.execute("""
-                        INSERT OR REPLACE INTO stock_info (symbol, name, sector, market, updated_at) 
-                        VALUES (?, ?, ?, ?, ?)
-                    """, (symbol, name, sector, cfg['name'], datetime.now().strftime("%Y-%m-%d")))
-                    stock_list.append((symbol, name))
+            # 💡 向量化過濾與組裝
+            # ⚠️ 代號欄直接取用：頁面改版或錯誤頁缺這欄時應拋 KeyError 整頁略過，
+            # 不能用 text_column 的預設值 (否則會寫入 'Unknown.TW' 這類假代號)
+            codes = df['有價證券代號'].astype(str).str.strip()
+            keep = codes.str.isalnum() & (codes.str.len() >= 4)
+            out = pd.DataFrame({'symbol': codes + cfg['suffix'], 'name': text_column(df, '有價證券名稱'),
+                                'sector': text_column(df, '產業別'), 'market': cfg['name'],
+                                'updated_at': today_str})[keep]
+            frames.append(out)
         except Exception as e:
             log(f"⚠️ {cfg['name']} 獲取失敗: {e}")
             
-    conn.commit()
-    conn.close()
-    return list(set(stock_list))
+    if not frames:
+        return []
+    # 💡 合併後一次去重 (保留原始順序，同類股票留在同一批次)
+    out = pd.concat(frames, ignore_index=True).drop_duplicates('symbol')
 
-# ========== 4. 下載邏輯 (單執行緒穩定版) ==========
-def download_one_stable(symbol, mode):
-    start_date = "2023-01-01" if mode == 'hot' else "1993-01-04"
-    try:
-        # 強制單執行緒，防止記憶體污染
-        df = yf.download(symbol, start=start_date, progress=False, timeout=20, 
-                         auto_adjust=True, threads=False)
-        if df is None or df.empty: return None
-        
-        if isinstance(df.columns, pd.MultiIndex):
-            df.columns = df.columns.get_level_values(0)
-        
-        df.reset_index(inplace=True)
-        df.columns = [c.lower() for c in df.columns]
-        df['date'] = pd.to_datetime(df['date']).dt.tz_localize(None).dt.strftime('%Y-%m-%d')
-        df_final = df[['date', 'open', 'high', 'low', 'close', 'volume']].copy()
-        df_final['symbol'] = symbol
-        return df_final
-    except:
-        return None
+    # 💡 整份清單一次 executemany + 單次 commit
+    # ⚠️ 有分類頁失敗或被略過時不留完成標記，同日重跑會重新下載而非沿用殘缺清單
+    complete = len(frames) == len(configs)
+    if not complete:
+        log(f"⚠️ 清單不完整 ({len(frames)}/{len(configs)} 個分類)，本次不列入清單快取")
+    save_stock_list(DB_PATH, list(out.itertuples(index=False, name=None)), complete=complete)
+    return list(zip(out['symbol'], out['name']))
 
-# ========== 5. 主流程 ==========
-def run_sync(mode='hot'):
+# ========== 3. 主流程 ==========
+def run_sync(mode='hot', start_date=None, end_date=None, max_workers=None):
     start_time = time.time()
-    init_db()
+    init_db(DB_PATH)
     
     items = get_tw_stock_list()
     if not items:
@@ -108,28 +100,17 @@ def run_sync(mode='hot'):
 
     log(f"🚀 開始同步 TW | 排除權證後剩餘: {len(items)} 檔 | 模式: {mode}")
 
-    success_count = 0
-    conn = sqlite3.connect(DB_PATH, timeout=60)
-    
-    pbar = tqdm(items, desc="TW同步")
-    for symbol, name in pbar:
-        df_res = download_one_stable(symbol, mode)
-        if df_res is not None:
-            df_res.to_sql('stock_prices', conn, if_exists='append', index=False, 
-                          method=lambda table, conn, keys, data_iter: 
-                          conn.executemany(f"INSERT OR REPLACE INTO {table.name} ({', '.join(keys)}) VALUES ({', '.join(['?']*len(keys))})", data_iter))
-            success_count += 1
-        time.sleep(0.05)
-    
-    conn.commit()
-    log(f"🧹 優化資料庫 (VACUUM)...")
-    conn.execute("VACUUM")
-    conn.close()
+    start_date = start_date or (HOT_START_DATE if mode == "hot" else COLD_START_DATE)
+    stats = sync_prices(DB_PATH, items, mode=mode, start_date=start_date, end_date=end_date,
+                        desc="TW同步", max_workers=max_workers, full_vacuum=FULL_VACUUM)
+    success_count = stats["success"]
+    close_conn(DB_PATH)  # 關閉後 WAL 才會完整寫回主檔，供 main.py 上傳
 
     duration = (time.time() - start_time) / 60
     log(f"📊 同步完成！更新成功: {success_count} / {len(items)} | 耗時: {duration:.1f} 分鐘")
     
-    return {"success": success_count, "total": len(items)}
+    return {"success": success_count, "total": len(items), "has_changed": stats["has_changed"],
+            "fail_list": stats["fail_list"]}
 
 if __name__ == "__main__":
     run_sync(mode='hot')
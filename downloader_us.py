@@ -2,49 +2,37 @@
 """
 downloader_us.py
 ----------------
-美股資料下載器（穩定單執行緒版）
+美股資料下載器（批次下載版）
 
-✔ 廢棄批量請求：改用單檔循環下載，徹底解決記憶體錯亂問題
+✔ 批次下載：單一呼叫端依序送出多檔請求，避免並行呼叫造成記憶體錯亂
 ✔ 精準過濾：自動剔除 Warrant, ETF, Preferred 等衍生品
 ✔ 結構對齊：完全支援全局自動化連動機制
 """
 
-import os, io, time, random, sqlite3, requests, re
+import os, json, time, re
 import pandas as pd
-import yfinance as yf
-from io import StringIO
 from datetime import datetime
-from tqdm import tqdm
+from warehouse_core import (
+    log, SESSION, get_conn, close_conn, init_db, sync_prices, load_cached_list,
+    save_stock_list,
+)
 
 # ========== 1. 環境判斷與參數設定 ==========
 MARKET_CODE = "us-share"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "us_stock_warehouse.db")
-
-def log(msg: str):
-    print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}", flush=True)
-
-# ========== 2. 資料庫初始化 ==========
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        conn.execute('''CREATE TABLE IF NOT EXISTS stock_prices (
-                            date TEXT, symbol TEXT, open REAL, high REAL, 
-                            low REAL, close REAL, volume INTEGER,
-                            PRIMARY KEY (date, symbol))''')
-        conn.execute('''CREATE TABLE IF NOT EXISTS stock_info (
-                            symbol TEXT PRIMARY KEY, name TEXT, sector TEXT, market TEXT, updated_at TEXT)''')
-        
-        cursor = conn.execute("PRAGMA table_info(stock_info)")
-        columns = [column[1] for column in cursor.fetchall()]
-        if 'market' not in columns:
-            log("🔧 正在升級 US 資料庫結構：新增 'market' 欄位...")
-            conn.execute("ALTER TABLE stock_info ADD COLUMN market TEXT")
-            conn.commit()
-    finally:
-        conn.close()
-
-# ========== 3. 獲取美股名單 (Nasdaq 官方 API) ==========
+# 💡 完整 VACUUM 會重寫整個 DB，只在設定 FULL_VACUUM=1 時執行 (例如每月一次)
+FULL_VACUUM = os.environ.get("FULL_VACUUM") == "1"
+# 熱/冷模式的預設起始日 (main.py 傳入 start_date 時以其為準)
+HOT_START_DATE = "2023-01-01"
+COLD_START_DATE = "2010-01-01"
+# 💡 名單一天最多變動一次，24 小時內直接沿用本地快取
+LIST_CACHE_PATH = os.path.join(BASE_DIR, "cache_us", "nasdaq_screener.json")
+LIST_CACHE_TTL = 86400
+# 名稱含這些關鍵字的衍生品一律排除 (模組載入時編譯一次)
+EXCLUDE_NAME_RE = re.compile(r"Warrant|Right|Preferred|Unit|ETF|Index|Index-linked", re.I)
+
+# ========== 2. 獲取美股名單 (Nasdaq 官方 API) ==========
 def get_us_stock_list_official():
     log("📡 正在從 Nasdaq 官方同步美股名單...")
     
@@ -55,85 +43,60 @@ def get_us_stock_list_official():
         'Referer': 'https://www.nasdaq.com/market-activity/stocks/screener'
     }
 
+    cache_fresh = (os.path.exists(LIST_CACHE_PATH)
+                   and time.time() - os.path.getmtime(LIST_CACHE_PATH) < LIST_CACHE_TTL)
+    if cache_fresh:
+        stock_list = load_cached_list(DB_PATH)
+        if stock_list:
+            log(f"♻️ 名單快取未過期，沿用資料庫既有清單: {len(stock_list)} 檔")
+            return stock_list
+
     try:
-        r = requests.get(url, headers=headers, timeout=30)
-        rows = r.json()['data']['rows']
+        if cache_fresh:
+            with open(LIST_CACHE_PATH, encoding="utf-8") as fh:
+                rows = json.load(fh)['data']['rows']
+        else:
+            r = SESSION.get(url, headers=headers, timeout=30)
+            rows = r.json()['data']['rows']
+            os.makedirs(os.path.dirname(LIST_CACHE_PATH), exist_ok=True)
+            with open(LIST_CACHE_PATH, "w", encoding="utf-8") as fh:
+                fh.write(r.text)
         
-        conn = sqlite3.connect(DB_PATH)
-        stock_list = []
-        exclude_kw = re.compile(r"Warrant|Right|Preferred|Unit|ETF|Index|Index-linked", re.I)
-
-        for row in rows:
-            symbol = str(row.get('symbol', '')).strip().upper()
+        today_str = datetime.now().strftime("%Y-%m-%d")
+
+        # 💡 名稱與代號過濾全部改用向量化字串運算，一次剔除衍生品
+        # 只取用得到的欄位，報價、市值等其餘欄位不建進 DataFrame
+        df = pd.DataFrame(rows, columns=['symbol', 'name', 'sector', 'exchange'])
+        names = df['name'].fillna('Unknown').astype(str).str.strip()
+        symbols = df['symbol'].fillna('').astype(str).str.strip().str.upper()
+        # 核心過濾：代號須為英數；5 碼以上且以 R/W/U 結尾者為權證/權利/單位
+        valid = (~names.str.contains(EXCLUDE_NAME_RE)
+                 & symbols.str.fullmatch(r'[A-Z0-9]+')
+                 & ~symbols.str.fullmatch(r'[A-Z0-9]{4,}[RWU]'))
+
+        def _text_col(col):
+            return df[col].fillna('Unknown').astype(str).str.strip()
+
+        sectors = _text_col('sector')
+        sectors = sectors.mask(sectors.str.lower().isin(['nan', 'n/a', '']), 'Unknown')
+
+        out = pd.DataFrame({'symbol': symbols, 'name': names, 'sector': sectors,
+                            'market': _text_col('exchange'), 'updated_at': today_str})[valid]
+        info_rows = list(out.itertuples(index=False, name=None))
+        stock_list = list(zip(out['symbol'], out['name']))
             
-            # 💡 核心過濾：排除衍生品
-            if not symbol or not symbol.isalnum(): continue
-            if len(symbol) > 4 and (symbol.endswith('R') or symbol.endswith('W') or symbol.endswith('U')):
-                continue
-            
-            name = str(row.get('name', 'Unknown')).strip()
-            if exclude_kw.search(name): continue
-            
-            sector = str(row.get('sector', 'Unknown')).strip()
-            market = str(row.get('exchange', 'Unknown')).strip()
-            
-            if not sector or sector.lower() in ['nan', 'n/a', '']: sector = "Unknown"
-
-            conn.execute("""
-                INSERT OR REPLACE INTO stock_info (symbol, name, sector, market, updated_at) 
-                VALUES (?, ?, ?, ?, ?)
-            """, (symbol, name, sector, market, datetime.now().strftime("%Y-%m-%d")))
-            stock_list.append((symbol, name))
-            
-        conn.commit()
-        conn.close()
+        # 💡 整份清單一次 executemany + 單次 commit
+        save_stock_list(DB_PATH, info_rows)
         log(f"✅ 美股清單導入成功: {len(stock_list)} 檔")
         return stock_list
     except Exception as e:
         log(f"❌ 獲取名單失敗: {e}")
         return []
 
-# ========== 4. 下載核心 (單執行緒穩定版) ==========
-def download_one_us(symbol, mode):
-    start_date = "2023-01-01" if mode == 'hot' else "2010-01-01"
-    max_retries = 1
-    
-    for attempt in range(max_retries + 1):
-        try:
-            # 💡 核心修正：threads=False 確保單線程穩定性
-            df = yf.download(symbol, start=start_date, progress=False, 
-                             auto_adjust=True, threads=False, timeout=30)
-            
-            if df is None or df.empty:
-                if attempt < max_retries:
-                    time.sleep(2)
-                    continue
-                return None
-            
-            if isinstance(df.columns, pd.MultiIndex):
-                df.columns = df.columns.get_level_values(0)
-            
-            df.reset_index(inplace=True)
-            df.columns = [c.lower() for c in df.columns]
-            
-            date_col = 'date' if 'date' in df.columns else df.columns[0]
-            df['date_str'] = pd.to_datetime(df[date_col]).dt.tz_localize(None).dt.strftime('%Y-%m-%d')
-            
-            df_final = df[['date_str', 'open', 'high', 'low', 'close', 'volume']].copy()
-            df_final.columns = ['date', 'open', 'high', 'low', 'close', 'volume']
-            df_final['symbol'] = symbol
-            
-            return df_final
-        except Exception:
-            if attempt < max_retries:
-                time.sleep(3)
-                continue
-            return None
-
-# ========== 5. 主流程 ==========
-def run_sync(mode='hot'):
+# ========== 3. 主流程 ==========
+def run_sync(mode='hot', start_date=None, end_date=None, max_workers=None):
     start_time = time.time()
-    init_db()
+    init_db(DB_PATH)
     
     items = get_us_stock_list_official()
     if not items:
@@ -141,30 +104,15 @@ def run_sync(mode='hot'):
 
     log(f"🚀 開始美股同步 (安全模式) | 目標: {len(items)} 檔")
 
-    success_count = 0
-    conn = sqlite3.connect(DB_PATH, timeout=60)
-    
-    # 💡 採用單執行緒循環下載
-    pbar = tqdm(items, desc="US同步")
-    for symbol, name in pbar:
-        df_res = download_one_us(symbol, mode)
-        
-        if df_res is not None:
-            df_res.to_sql('stock_prices', conn, if_exists='append', index=False, 
-                          method=lambda table, conn, keys, data_iter: 
-                          conn.executemany(f"INSERT OR REPLACE INTO {table.name} ({', '.join(keys)}) VALUES ({', '.join(['?']*len(keys))})", data_iter))
-            success_count += 1
-            
-        # 🟢 加入極小延遲，確保不會被 Yahoo Finance 判定為 DDoS 攻擊
-        time.sleep(0.02)
-    
-    conn.commit()
-    
-    # 統計與維護
-    log("🧹 執行資料庫 VACUUM...")
-    conn.execute("VACUUM")
-    db_info_count = conn.execute("SELECT COUNT(DISTINCT symbol) FROM stock_info").fetchone()[0]
-    conn.close()
+    start_date = start_date or (HOT_START_DATE if mode == "hot" else COLD_START_DATE)
+    stats = sync_prices(DB_PATH, items, mode=mode, start_date=start_date, end_date=end_date,
+                        desc="US同步", max_workers=max_workers, full_vacuum=FULL_VACUUM)
+    success_count = stats["success"]
+    conn = get_conn(DB_PATH)
+
+    # 統計
+    db_info_count = conn.execute("SELECT COUNT(*) FROM stock_info").fetchone()[0]
+    close_conn(DB_PATH)  # 關閉後 WAL 才會完整寫回主檔，供 main.py 上傳
 
     duration = (time.time() - start_time) / 60
     log(f"📊 同步完成！費時: {duration:.1f} 分鐘")
@@ -173,7 +121,8 @@ def run_sync(mode='hot'):
     return {
         "success": success_count,
         "total": db_info_count,
-        "has_changed": success_count > 0
+        "has_changed": stats["has_changed"],
+        "fail_list": stats["fail_list"]
     }
 
 if __name__ == "__main__":
@@ -1,16 +1,74 @@
 # -*- coding: utf-8 -*-
-import os, re, glob, time, sqlite3, gzip
+import os, re, time, sqlite3, gzip, shutil, zlib, atexit
 from pathlib import Path
-from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 
 # ========== 核心路徑設定 ==========
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 AUDIT_DB_PATH = os.path.join(BASE_DIR, "data_warehouse_audit.db")
+TZ8 = timezone(timedelta(hours=8))  # 審計時間一律記台北時間 (UTC+8)
 OUTPUT_BASE = os.path.join(BASE_DIR, "data", "processed_wmy")
+# 審計 DB 連線：首次使用時建立並建表，之後整個行程共用
+_AUDIT_CONN = None
+# 審計 DB 結構 (連線建立時執行一次)
+# 💡 wmy_file_cache 為逐檔快取：CSV 未變動 (mtime 相同) 時直接沿用上次的 W/M/Y 結果 (Arrow IPC)
+AUDIT_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS wmy_conversion_audit (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    execution_time TEXT,
+    market_id TEXT,
+    total_files INTEGER,
+    success_count INTEGER,
+    skip_count INTEGER,
+    success_rate REAL
+);
+CREATE TABLE IF NOT EXISTS wmy_file_cache (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    rows_w BLOB,
+    rows_m BLOB,
+    rows_y BLOB
+);
+"""
+# 週/月/年輸出目錄 (順序與 _process_one_file 回傳的三個 Table 一致)
+PERIODS = ("weekly", "monthly", "yearly")
+# 💡 依 StockID 雜湊分桶 (Hive 目錄 weekly/bucket=K/part.parquet)，下游可平行掃描各桶
+WMY_BUCKETS = 16
+# 💡 同一桶的多檔股票累積到約這個列數才寫成一個 row group
+# (年線每檔只有幾十列，一檔一個 row group 會讓 footer 比資料本身還大)
+WMY_ROW_GROUP_ROWS = 65536
+# 💡 輸出欄位型別固定：OHLC 與漲跌幅以 float32 (約 7 位有效數字，足夠表示股價與四位小數報酬)
+# 寫出位元組約減半，且各行程產出的 Table schema 完全一致
+# ⚠️ 成交量維持 int64：月/年加總常超過 int32 上限 (約 21 億股)
+# 欄位依編碼後大小排列：小欄位 (StockID/日期/成交量) 相鄰，只讀部分欄位時可合併 IO
+PERIOD_SCHEMA = pa.schema([
+    ('StockID', pa.string()), ('日期', pa.timestamp('ns')), ('成交量', pa.int64()),
+    ('漲跌幅', pa.float32()), ('開盤', pa.float32()), ('最高', pa.float32()),
+    ('最低', pa.float32()), ('收盤', pa.float32())
+])
+
+# 💡 日 K CSV 欄位對照 (英文 -> 中文) 與 Arrow 解析型別
+COLUMN_RENAME = {
+    'date': '日期', 'open': '開盤', 'high': '最高',
+    'low': '最低', 'close': '收盤', 'volume': '成交量'
+}
+# 成交量以 float64 解析：來源 CSV 若含空值會寫成 "123.0"，int64 會解析失敗
+CSV_COLUMN_TYPES = {
+    'date': pa.timestamp('ns'), 'open': pa.float64(), 'high': pa.float64(),
+    'low': pa.float64(), 'close': pa.float64(), 'volume': pa.float64()
+}
+# 外層已有執行緒池，單檔解析不再另開執行緒
+CSV_READ_OPTIONS = pacsv.ReadOptions(use_threads=False)
+CSV_CONVERT_OPTIONS = pacsv.ConvertOptions(column_types=CSV_COLUMN_TYPES)
+# 斷層偵測的起始日 (與 日期 欄同型別，可直接在 Arrow 上比較)
+GAP_CHECK_START = pa.scalar(datetime(2024, 1, 1), type=pa.timestamp('ns'))
 
 # ========== 內部工具函式 ==========
 
@@ -22,65 +80,106 @@ def _canonical_id(raw_id):
     """標準化代號格式"""
     return str(raw_id).strip().upper()
 
+def _bucket_of(cid):
+    """代號 -> 分桶編號 (crc32 跨行程、跨執行穩定，不受 Python hash 隨機化影響)"""
+    return zlib.crc32(cid.encode('utf-8')) % WMY_BUCKETS
+
 def _load_day_clean_full(path):
-    """載入 CSV 並進行基礎清洗與格式化"""
-    df = pd.read_csv(path)
+    """載入 CSV 並進行基礎清洗與格式化，回傳依日期排序的 Arrow Table"""
+    # 💡 以 pyarrow 的 C++ 解析器讀檔，型別在解析時即確定，不必再 to_datetime
+    table = pacsv.read_csv(path, read_options=CSV_READ_OPTIONS,
+                           convert_options=CSV_CONVERT_OPTIONS)
     # 統一欄位名稱為中文以利後續邏輯一致
-    rename_map = {
-        'date': '日期', 'open': '開盤', 'high': '最高', 
-        'low': '最低', 'close': '收盤', 'volume': '成交量'
-    }
-    df = df.rename(columns=rename_map)
-    df['日期'] = pd.to_datetime(df['日期'])
-    # 移除任何空值
-    df = df.dropna(subset=['開盤', '最高', '最低', '收盤'])
-    return df
+    table = table.rename_columns([COLUMN_RENAME.get(c, c) for c in table.column_names])
+    # 移除任何空值 (在 Arrow 層過濾，轉 pandas 前就剔除)
+    valid = pc.and_(pc.and_(pc.is_valid(table['開盤']), pc.is_valid(table['最高'])),
+                    pc.and_(pc.is_valid(table['最低']), pc.is_valid(table['收盤'])))
+    return table.filter(valid).sort_by('日期')
 
-def _resample_ohlc_with_flags(df, period):
+def _period_end_keys(days):
     """
-    執行 OHLC 採樣轉換
-    W=週, M=月, Y=年
+    以 numpy 日期運算直接算出每一天所屬週期的結束日 (與 resample 的標籤一致)
+    W=週五為結束 (W-FRI), M=月底, Y=年底
     """
-    resampler = df.set_index('日期').resample(period)
-    df_res = resampler.agg({
-        '開盤': 'first',
-        '最高': 'max',
-        '最低': 'min',
-        '收盤': 'last',
-        '成交量': 'sum'
-    }).dropna()
-    return df_res.reset_index()
+    d = days.astype('int64')  # 1970-01-01 (週四) 起算的天數
+    week_end = (d + (1 - d) % 7).astype('datetime64[D]')
+    month_end = (days.astype('datetime64[M]') + 1).astype('datetime64[D]') - 1
+    year_end = (days.astype('datetime64[Y]') + 1).astype('datetime64[D]') - 1
+    return week_end, month_end, year_end
+
+def _resample_ohlc_with_flags(key, o, h, l, c, v):
+    """
+    執行 OHLC 採樣轉換：key 已排序，依邊界索引以 reduceat 一次彙總
+    開=首筆, 高=最大, 低=最小, 收=末筆, 量=加總
+    """
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    ends = np.r_[starts[1:], len(key)] - 1
+    return pd.DataFrame({
+        '日期': key[starts].astype('datetime64[ns]'),
+        '開盤': o[starts],
+        '最高': np.maximum.reduceat(h, starts),
+        '最低': np.minimum.reduceat(l, starts),
+        '收盤': c[ends],
+        '成交量': np.rint(np.add.reduceat(v, starts)).astype('int64')
+    })
+
+def _resample_wmy(df):
+    """週/月/年三種週期共用同一份已排序的日 K 陣列，各只掃一次 (df 須已依日期排序)"""
+    days = df['日期'].to_numpy().astype('datetime64[D]')
+    cols = (df['開盤'].to_numpy(), df['最高'].to_numpy(), df['最低'].to_numpy(),
+            df['收盤'].to_numpy(), np.nan_to_num(df['成交量'].to_numpy(dtype='float64')))
+    return tuple(_resample_ohlc_with_flags(key, *cols) for key in _period_end_keys(days))
 
 def _add_period_returns(df, period):
-    """計算週期漲跌幅"""
-    if not df.empty:
-        df['漲跌幅'] = df['收盤'].pct_change().round(4)
+    """計算週期漲跌幅 (df 為採樣結果，必不為空)"""
+    # 💡 直接在 numpy 陣列上相除，省去 pct_change / round 的中介 Series
+    close = df['收盤'].to_numpy(dtype='float64')
+    ret = np.empty_like(close)
+    ret[0] = np.nan
+    np.divide(close[1:], close[:-1], out=ret[1:])
+    ret[1:] -= 1
+    df['漲跌幅'] = np.round(ret, 4, out=ret)
     return df
 
 # ========== 審計與處理核心 ==========
 
+def _audit_conn():
+    """取得審計資料庫連線 (延遲建立，多個市場連續轉換時不重複開檔與建表)"""
+    global _AUDIT_CONN
+    if _AUDIT_CONN is None:
+        conn = sqlite3.connect(AUDIT_DB_PATH)
+        conn.executescript(AUDIT_SCHEMA_SQL)
+        _AUDIT_CONN = conn
+    return _AUDIT_CONN
+
+@atexit.register
+def _close_audit_conn():
+    global _AUDIT_CONN
+    if _AUDIT_CONN is not None:
+        _AUDIT_CONN.close()
+        _AUDIT_CONN = None
+
+def _table_to_ipc(table):
+    """Arrow Table -> IPC stream bytes (存入快取)"""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def _ipc_to_table(blob):
+    """IPC stream bytes -> Arrow Table (讀取快取)"""
+    return pa.ipc.open_stream(blob).read_all()
+
 def record_conversion_audit(market_key, total, success, skip_records):
     """將轉換結果寫入審計資料庫 (修正為 UTC+8)"""
-    conn = sqlite3.connect(AUDIT_DB_PATH)
-    try:
-        conn.execute('''CREATE TABLE IF NOT EXISTS wmy_conversion_audit (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            execution_time TEXT,
-            market_id TEXT,
-            total_files INTEGER,
-            success_count INTEGER,
-            skip_count INTEGER,
-            success_rate REAL
-        )''')
-        # 修正時區
-        now = (datetime.utcnow() + timedelta(hours=8)).strftime("%Y-%m-%d %H:%M:%S")
-        skip = len(skip_records)
-        rate = round((success / total * 100), 2) if total > 0 else 0
+    conn = _audit_conn()
+    # 修正時區
+    now = datetime.now(TZ8).strftime("%Y-%m-%d %H:%M:%S")
+    skip = len(skip_records)
+    rate = round((success / total * 100), 2) if total > 0 else 0
+    with conn:
         conn.execute('INSERT INTO wmy_conversion_audit (execution_time, market_id, total_files, success_count, skip_count, success_rate) VALUES (?,?,?,?,?,?)',
                      (now, market_key, total, success, skip, rate))
-        conn.commit()
-    finally:
-        conn.close()
 
 def _process_one_file(path: str):
     """整合資料異常分析的核心邏輯"""
@@ -90,38 +189,37 @@ def _process_one_file(path: str):
         cid = _canonical_id(raw_id)
 
         # 1. 載入與基礎清洗
-        df_day = _load_day_clean_full(path)
-        if df_day.empty:
+        table = _load_day_clean_full(path)
+        if table.num_rows == 0:
             return "SKIP", {'StockID': cid, 'reason': 'empty_file'}, "空檔案"
-        
+
+        # 💡 2、3 兩項檢查直接在 Arrow 上做，被剔除的檔案完全不必轉成 pandas
         # 2. 異常檢查：價格必須 > 0
-        if (df_day['收盤'] <= 0).any():
+        if pc.any(pc.less_equal(table['收盤'], 0)).as_py():
             return "SKIP", {'StockID': cid, 'reason': 'invalid_price'}, "價格含負值或零"
 
         # 3. 斷層偵測：檢查 2024 年後是否有超過 14 天的資料斷層
         # 注意：對於日股/美股，國定假日可能導致超過 14 天的斷層，此處門檻可視情況調整
-        df_check = df_day[df_day['日期'] >= '2024-01-01'].sort_values('日期')
-        if not df_check.empty and len(df_check) > 1:
-            gaps = df_check['日期'].diff().dt.days
-            if gaps.max() > 14:
-                return "SKIP", {'StockID': cid, 'reason': f'gap_{int(gaps.max())}d'}, "存在長日期斷層"
+        dates = table['日期'].filter(pc.greater_equal(table['日期'], GAP_CHECK_START)).combine_chunks()
+        max_gap = pc.max(pc.days_between(dates[:-1], dates[1:])).as_py()
+        if max_gap is not None and max_gap > 14:
+            return "SKIP", {'StockID': cid, 'reason': f'gap_{max_gap}d'}, "存在長日期斷層"
 
         # 4. 執行轉換
-        dfw = _resample_ohlc_with_flags(df_day, 'W-FRI') # 週五為結束
+        dfw, dfm, dfy = _resample_wmy(table.to_pandas()) # 週以週五為結束
         dfw = _add_period_returns(dfw, 'W'); dfw['StockID'] = cid
-        
-        dfm = _resample_ohlc_with_flags(df_day, 'M')
         dfm = _add_period_returns(dfm, 'M'); dfm['StockID'] = cid
-        
-        dfy = _resample_ohlc_with_flags(df_day, 'Y')
         dfy = _add_period_returns(dfy, 'Y'); dfy['StockID'] = cid
 
         # 5. OHLC 邏輯驗證
         for _df in [dfw, dfm, dfy]:
-            if ((_df['收盤'] > _df['最高']) | (_df['收盤'] < _df['最低'])).any():
+            c = _df['收盤'].to_numpy()
+            if ((c > _df['最高'].to_numpy()) | (c < _df['最低'].to_numpy())).any():
                 return "SKIP", {'StockID': cid, 'reason': 'ohlc_logic_error'}, "OHLC 邏輯錯誤"
 
-        return True, (dfw, dfm, dfy), None
+        # 💡 回傳 Arrow Table：跨行程傳遞時序列化成本遠低於 DataFrame
+        return True, tuple(pa.Table.from_pandas(d, schema=PERIOD_SCHEMA, preserve_index=False)
+                           for d in (dfw, dfm, dfy)), None
     except Exception as e:
         return False, None, str(e)
 
@@ -132,39 +230,116 @@ def main(market_id, input_dir):
     主進入點：將指定目錄的 CSV 轉為 WMY Parquet
     """
     print(f"🛠️ 開始執行 {market_id} 週期轉換任務...")
-    csv_files = glob.glob(os.path.join(input_dir, "*.csv"))
-    total = len(csv_files)
-    
+    # 💡 scandir 一次取得檔名、mtime 與大小，不必逐檔再 stat
+    with os.scandir(input_dir) as it:
+        csv_stats = {e.path: e.stat() for e in it
+                     if e.name.endswith(".csv") and e.is_file()}
+    total = len(csv_stats)
+
+    market_out = os.path.join(OUTPUT_BASE, market_id)
+    # ⚠️ 開始前一律清掉舊輸出 (含舊版單檔 weekly.parquet 等)：
+    # 即使本次全部失敗或略過，也不會留下上一次的結果被當成最新資料
+    for name in PERIODS:
+        shutil.rmtree(os.path.join(market_out, name), ignore_errors=True)
+        if os.path.exists(os.path.join(market_out, f"{name}.parquet")):
+            os.remove(os.path.join(market_out, f"{name}.parquet"))
+
     if total == 0:
         return {"total": 0, "success": 0, "fail": 0, "fail_list": []}
 
     success_count = 0
     fail_list = []
-    
-    all_w, all_m, all_y = [], [], []
-
-    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-        futures = {executor.submit(_process_one_file, f): f for f in csv_files}
-        
-        for future in as_completed(futures):
-            res_type, data, reason = future.result()
-            if res_type is True:
-                success_count += 1
-                w, m, y = data
-                all_w.append(w); all_m.append(m); all_y.append(y)
-            elif res_type == "SKIP":
-                fail_list.append(f"{data['StockID']}({data['reason']})")
-            else:
-                fail_list.append(f"Error_{reason}")
-
-    # 儲存結果為 Parquet (高效能壓縮格式)
-    if all_w:
-        market_out = os.path.join(OUTPUT_BASE, market_id)
-        os.makedirs(market_out, exist_ok=True)
-        
-        pd.concat(all_w).to_parquet(os.path.join(market_out, "weekly.parquet"), index=False)
-        pd.concat(all_m).to_parquet(os.path.join(market_out, "monthly.parquet"), index=False)
-        pd.concat(all_y).to_parquet(os.path.join(market_out, "yearly.parquet"), index=False)
+
+    # 💡 串流寫入：各 (週期, 桶) 累積約 WMY_ROW_GROUP_ROWS 列就寫出一個 row group，
+    # 不在記憶體中累積整個市場；讀取端仍可依 StockID 統計值略過不相干的 row group
+    writers = {}  # (週期索引, 桶號) -> ParquetWriter
+    buffers = {}  # (週期索引, 桶號) -> [待寫出的 Table list, 累積列數]
+
+    def _flush(key, tables):
+        table = pa.concat_tables(tables)
+        if key not in writers:
+            i, bucket = key
+            bucket_dir = os.path.join(market_out, PERIODS[i], f"bucket={bucket}")
+            os.makedirs(bucket_dir, exist_ok=True)
+            writers[key] = pq.ParquetWriter(
+                os.path.join(bucket_dir, "part.parquet"), table.schema,
+                compression='zstd', compression_level=3,
+                use_dictionary=['StockID'], write_statistics=True,
+                column_encoding={'日期': 'DELTA_BINARY_PACKED'})
+        writers[key].write_table(table, row_group_size=table.num_rows)
+
+    def _flush_keys(keys):
+        # 💡 不同 (週期, 桶) 的檔案互不相干，zstd 編碼會釋放 GIL，交給執行緒同時寫
+        jobs = [write_pool.submit(_flush, key, buffers.pop(key)[0]) for key in keys]
+        for f in jobs:
+            f.result()
+
+    def _write_tables(tables):
+        bucket = _bucket_of(tables[0]['StockID'][0].as_py())
+        full = []
+        for i, t in enumerate(tables):
+            buf = buffers.setdefault((i, bucket), [[], 0])
+            buf[0].append(t)
+            buf[1] += t.num_rows
+            if buf[1] >= WMY_ROW_GROUP_ROWS:
+                full.append((i, bucket))
+        if full:
+            _flush_keys(full)
+
+    conn = _audit_conn()
+    cached_mtime = dict(conn.execute("SELECT path, mtime FROM wmy_file_cache"))
+    # 💡 本目錄中已不存在的 CSV 刪掉其快取 (每列含三份 IPC，不清會無限成長)
+    # 快取表由各市場共用，只清本目錄底下的路徑
+    scan_dir = os.path.dirname(os.path.join(input_dir, "_"))
+    stale = [p for p in cached_mtime if os.path.dirname(p) == scan_dir and p not in csv_stats]
+    if stale:
+        with conn:
+            conn.executemany("DELETE FROM wmy_file_cache WHERE path = ?", [(p,) for p in stale])
+        print(f"🧹 清除已移除檔案的快取: {len(stale)} 筆")
+
+    # 💡 解析、採樣都是 CPU 密集且大多持有 GIL，改用多行程才能真正平行
+    try:
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor, \
+             ThreadPoolExecutor(max_workers=len(PERIODS)) as write_pool:
+            # 未變動的檔案直接寫入快取結果；輸出欄位型別變更過的舊快取則重新轉換
+            csv_files = []
+            for path, st in csv_stats.items():
+                if cached_mtime.get(path) == st.st_mtime:
+                    row = conn.execute("SELECT rows_w, rows_m, rows_y FROM wmy_file_cache WHERE path = ?",
+                                       (path,)).fetchone()
+                    tables = tuple(_ipc_to_table(b) for b in row)
+                    if all(t.schema.equals(PERIOD_SCHEMA) for t in tables):
+                        success_count += 1
+                        _write_tables(tables)
+                        continue
+                csv_files.append(path)
+            if csv_files:
+                print(f"♻️ 沿用快取 {total - len(csv_files)} 檔，重新轉換 {len(csv_files)} 檔")
+            # 💡 大檔先送 (LPT 排程)，避免最後才輪到的大檔讓其他核心閒置等待
+            csv_files.sort(key=lambda p: csv_stats[p].st_size, reverse=True)
+
+            # 💡 以 map + chunksize 分批派工，減少逐檔 submit 的行程間往返
+            workers = os.cpu_count() or 1
+            chunksize = max(1, len(csv_files) // (workers * 4))
+            results = executor.map(_process_one_file, csv_files, chunksize=chunksize)
+
+            for path, (res_type, data, reason) in zip(csv_files, results):
+                if res_type is True:
+                    success_count += 1
+                    _write_tables(data)
+                    conn.execute("INSERT OR REPLACE INTO wmy_file_cache VALUES (?,?,?,?,?)",
+                                 (path, csv_stats[path].st_mtime, *(_table_to_ipc(t) for t in data)))
+                elif res_type == "SKIP":
+                    fail_list.append(f"{data['StockID']}({data['reason']})")
+                else:
+                    fail_list.append(f"Error_{reason}")
+
+            # 寫出各桶剩餘未滿一個 row group 的資料
+            _flush_keys(list(buffers))
+    finally:
+        conn.commit()
+        for writer in writers.values():
+            writer.close()
 
     # 紀錄審計
     record_conversion_audit(market_id, total, success_count, fail_list)
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
-import os, sys, sqlite3, json, time, socket, io
-import pandas as pd
+import os, sys, sqlite3, json, time, socket, io, gzip, shutil, functools, threading, hashlib, multiprocessing
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
 from dotenv import load_dotenv
+import zstandard as zstd
 
 # 💡 1. 環境設定
 load_dotenv() 
@@ -17,6 +19,19 @@ FORCE_END_DATE = "2026-12-31"
 
 GDRIVE_FOLDER_ID = os.environ.get('GDRIVE_FOLDER_ID')
 SERVICE_ACCOUNT_FILE = 'citric-biplane-319514-75fead53b0f5.json'
+# 💡 DB 以 zstd 壓縮後上傳 (SQLite 檔壓縮率高)；-1 表示整檔以單一串流 PUT 送出，
+# 不必每段等一次 HTTP 來回，仍保留 resumable 以便失敗時從已送達的位置續傳
+UPLOAD_CHUNK_SIZE = -1
+# zstd 等級：1~5 求快、10~15 為預設的平衡區間、19~22 適合封存；多執行緒編碼吃滿所有核心
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", "15"))
+# ⚠️ 下游 Alpha-Data-Cleaning-Lab 仍讀取未壓縮的 <market>_stock_warehouse.db：
+# 在它改讀 .zst 之前維持同步上傳未壓縮檔；設為 0 則只保留 .zst 並移除雲端未壓縮檔
+UPLOAD_RAW_DB = os.environ.get("UPLOAD_RAW_DB", "1") == "1"
+# Drive 暫時性錯誤 (5xx / 429 / 網路中斷) 的指數退避重試
+DRIVE_RETRIES = 5
+DRIVE_BACKOFF_MAX = 30
+# 空頁超過 1/20 才以 VACUUM INTO 壓實快照，否則直接逐頁備份
+SNAPSHOT_VACUUM_RATIO = 20
 
 # 💡 2. 導入特徵加工模組
 try:
@@ -34,94 +49,251 @@ except Exception as e:
     notifier = None
 
 import downloader_tw, downloader_us, downloader_cn, downloader_hk, downloader_jp, downloader_kr
+from warehouse_core import get_conn, close_conn, share_rate_limit
 
 # 📊 門檻門檻設定
 EXPECTED_MIN_STOCKS = {
     'tw': 2500, 'us': 5684, 'cn': 5496, 'hk': 2689, 'jp': 4315, 'kr': 2000
 }
+# 同時同步的市場數上限 (各行程仍共用同一個 Yahoo 請求限流)
+MAX_MARKET_WORKERS = 3
 
 # ========== [Google Drive 相關函式 - 原封不動保留] ==========
 
-def get_drive_service():
+@functools.lru_cache(maxsize=1)
+def _drive_credentials():
+    """服務帳號憑證整次執行只解析一次 (各執行緒的 service 共用，token 也只需取得一次)"""
     env_json = os.environ.get('GDRIVE_SERVICE_ACCOUNT')
+    if env_json:
+        info = json.loads(env_json)
+        return service_account.Credentials.from_service_account_info(info, scopes=['https://www.googleapis.com/auth/drive'])
+    if os.path.exists(SERVICE_ACCOUNT_FILE):
+        return service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=['https://www.googleapis.com/auth/drive'])
+    return None
+
+# googleapiclient 的 service (底層 httplib2 連線) 非執行緒安全：每個執行緒快取自己的一份
+_drive_tls = threading.local()
+
+def get_drive_service():
+    service = getattr(_drive_tls, 'service', None)
+    if service is not None:
+        return service
     try:
-        if env_json:
-            info = json.loads(env_json)
-            creds = service_account.Credentials.from_service_account_info(info, scopes=['https://www.googleapis.com/auth/drive'])
-        elif os.path.exists(SERVICE_ACCOUNT_FILE):
-            creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=['https://www.googleapis.com/auth/drive'])
-        else:
+        creds = _drive_credentials()
+        if creds is None:
             return None
-        return build('drive', 'v3', credentials=creds, cache_discovery=False)
+        service = _drive_tls.service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+        return service
     except Exception as e:
         print(f"❌ 無法初始化 Drive 服務: {e}")
         return None
 
-def download_db_from_drive(service, file_name, retries=3):
-    query = f"name = '{file_name}' and '{GDRIVE_FOLDER_ID}' in parents and trashed = false"
+def is_retryable(e):
+    """只有 5xx、429 與網路層錯誤值得重試；其餘 (權限、找不到檔案等) 重試也不會成功"""
+    if isinstance(e, HttpError):
+        return e.resp.status == 429 or e.resp.status >= 500
+    return isinstance(e, OSError)  # 含 socket.timeout、連線重置
+
+def drive_backoff(attempt, e, label):
+    """失敗時印出原因並等待 1, 2, 4, ... 秒 (上限 DRIVE_BACKOFF_MAX)；回傳 False 表示不必再試"""
+    print(f"⚠️ {label}失敗 ({attempt+1}/{DRIVE_RETRIES}): {e}")
+    if not is_retryable(e) or attempt + 1 >= DRIVE_RETRIES:
+        return False
+    time.sleep(min(DRIVE_BACKOFF_MAX, 2 ** attempt))
+    return True
+
+def list_drive_files(service, names=None, retries=DRIVE_RETRIES):
+    """
+    一次查出雲端資料夾內的檔案 {name: {id, md5Checksum}}，各市場共用，不必每次上傳/下載都查詢。
+    💡 給了 names 就只查這些檔名 (單次 OR 查詢)，資料夾內其他檔案再多也不會超過一頁
+    """
+    query = f"'{GDRIVE_FOLDER_ID}' in parents and trashed = false"
+    if names:
+        query += " and (" + " or ".join(f"name = '{n}'" for n in names) + ")"
     for attempt in range(retries):
         try:
-            results = service.files().list(q=query, fields="files(id)").execute()
-            items = results.get('files', [])
-            if not items: return False
-            file_id = items[0]['id']
-            print(f"📡 正在從雲端下載數據庫: {file_name}")
+            results = service.files().list(q=query, fields="files(id,name,md5Checksum)", pageSize=1000).execute()
+            return {f['name']: f for f in results.get('files', [])}
+        except Exception as e:
+            if not drive_backoff(attempt, e, "雲端檔案清單讀取"):
+                break
+    return None
+
+def download_db_from_drive(service, file_name, existing, retries=DRIVE_RETRIES):
+    zst_name, gz_name = f"{file_name}.zst", f"{file_name}.gz"
+    # 優先取 zstd 版，找不到再退回舊的 gzip 版與未壓縮檔
+    remote_name = next((n for n in (zst_name, gz_name, file_name) if n in existing), None)
+    if remote_name is None: return False
+    file_id = existing[remote_name]['id']
+    for attempt in range(retries):
+        try:
+            print(f"📡 正在從雲端下載數據庫: {remote_name}")
             request = service.files().get_media(fileId=file_id)
-            with io.FileIO(file_name, 'wb') as fh:
+            with io.FileIO(remote_name, 'wb') as fh:
                 downloader = MediaIoBaseDownload(fh, request, chunksize=5*1024*1024)
                 done = False
                 while not done:
                     _, done = downloader.next_chunk()
+            if remote_name == zst_name:
+                with open(zst_name, 'rb') as src, open(file_name, 'wb') as dst:
+                    zstd.ZstdDecompressor().copy_stream(src, dst, read_size=1 << 20, write_size=1 << 20)
+                os.remove(zst_name)
+            elif remote_name == gz_name:
+                with gzip.open(gz_name, 'rb') as src, open(file_name, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, length=8 << 20)
+                os.remove(gz_name)
             return True
         except Exception as e:
-            print(f"⚠️ 下載失敗 ({attempt+1}/3): {e}")
-            time.sleep(5)
+            if not drive_backoff(attempt, e, "下載"):
+                break
     return False
 
-def upload_db_to_drive(service, file_path, retries=3):
-    file_name = os.path.basename(file_path)
-    media = MediaFileUpload(file_path, mimetype='application/x-sqlite3', resumable=True)
-    query = f"name = '{file_name}' and '{GDRIVE_FOLDER_ID}' in parents and trashed = false"
+def file_md5(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(8 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def make_snapshot(conn, file_path):
+    """
+    產生上傳用的一致快照，不影響仍在使用中的 DB (WAL 內容也會一併寫入)：
+    - 空頁不多時用 Online Backup API 逐頁複製，不必重建 B-tree
+    - 空頁偏多才 VACUUM INTO，輸出無空頁的壓實檔
+    兩種方式產出的都是 journal_mode=DELETE 的單一檔案，下載端唯讀開啟即可使用。
+    """
+    snap_path = f"{file_path}.snap"
+    if os.path.exists(snap_path):
+        os.remove(snap_path)
+    freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    pages = conn.execute("PRAGMA page_count").fetchone()[0]
+    if freelist > pages // SNAPSHOT_VACUUM_RATIO:
+        conn.execute("VACUUM INTO ?", (snap_path,))
+    else:
+        dst = sqlite3.connect(snap_path)
+        try:
+            conn.backup(dst)
+            # ⚠️ Backup 會連同來源的 WAL 檔頭一起複製，改回 rollback journal，
+            # 否則下載端開啟時需要寫入權限建立 -wal/-shm
+            dst.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            dst.close()
+    return snap_path
+
+def upload_file_to_drive(service, local_path, file_name, mimetype, existing, retries=DRIVE_RETRIES):
+    """上傳單一檔案到雲端資料夾 (同名則更新)，內容與雲端相同時略過"""
+    local_md5 = file_md5(local_path)
+    # 💡 內容未變 (例如同日重跑) 就不重傳整個 DB
+    if existing.get(file_name, {}).get('md5Checksum') == local_md5:
+        print(f"⏭️ 內容未變動，略過上傳: {file_name}")
+        return True
+    media = MediaFileUpload(local_path, mimetype=mimetype, resumable=True, chunksize=UPLOAD_CHUNK_SIZE)
     for attempt in range(retries):
         try:
-            results = service.files().list(q=query, fields="files(id)").execute()
-            items = results.get('files', [])
-            if items:
-                service.files().update(fileId=items[0]['id'], media_body=media).execute()
+            if file_name in existing:
+                request = service.files().update(fileId=existing[file_name]['id'], media_body=media, fields='id')
             else:
                 meta = {'name': file_name, 'parents': [GDRIVE_FOLDER_ID]}
-                service.files().create(body=meta, media_body=media).execute()
-            print(f"✅ 上傳成功: {file_name} ({os.path.getsize(file_path)/1024/1024:.2f} MB)")
+                request = service.files().create(body=meta, media_body=media, fields='id')
+            # 💡 整檔一次送出通常一輪就完成；中斷時 next_chunk 會向伺服器查詢進度後續傳
+            response = None
+            while response is None:
+                _, response = request.next_chunk(num_retries=5)
+            existing[file_name] = {'id': response['id'], 'md5Checksum': local_md5}
+            print(f"✅ 上傳成功: {file_name} ({os.path.getsize(local_path)/1024/1024:.2f} MB)")
+            return True
+        except Exception as e:
+            if not drive_backoff(attempt, e, "上傳"):
+                break
+    # 💡 重試用盡仍失敗才通知，避免下次排程前都沒人發現雲端檔過期
+    if notifier:
+        notifier.send_telegram(f"❌ 雲端上傳失敗: {file_name}")
+    return False
+
+def trash_drive_file(service, file_name, existing, retries=DRIVE_RETRIES):
+    """把不再更新的舊檔移到垃圾桶，避免下游誤讀過期資料"""
+    for attempt in range(retries):
+        try:
+            service.files().update(fileId=existing[file_name]['id'], body={'trashed': True}, fields='id').execute()
+            existing.pop(file_name, None)
+            print(f"🗑️ 已移除舊版雲端檔: {file_name}")
             return True
         except Exception as e:
-            print(f"⚠️ 上傳失敗 ({attempt+1}/3): {e}")
-            time.sleep(5)
+            if not drive_backoff(attempt, e, "舊檔移除"):
+                break
     return False
 
-def check_needs_update(db_path):
-    if not os.path.exists(db_path): return True
+def upload_db_to_drive(service, file_path, existing, snapshot=None, retries=DRIVE_RETRIES):
+    """
+    上傳 file_path (雲端檔名沿用其名稱)；給了 snapshot 就改上傳快照，結束後刪除。
+    - 主檔：<db>.zst
+    - UPLOAD_RAW_DB 開啟時同步更新未壓縮的 <db> (下游仍讀取此檔)，關閉時改為移除
+    - 舊版 <db>.gz 一律移除
+    """
+    zst_path = f"{file_path}.zst"
+    src_path = snapshot or file_path
+    try:
+        # 💡 zstd 多執行緒編碼 (threads=-1 依核心數)，輸出與執行緒數無關，
+        # 內容相同時壓縮檔逐位元相同，才能與雲端 md5Checksum 比對
+        cctx = zstd.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+        with open(src_path, 'rb') as src, open(zst_path, 'wb') as dst:
+            cctx.copy_stream(src, dst, read_size=1 << 20, write_size=1 << 20)
+        ok = upload_file_to_drive(service, zst_path, os.path.basename(zst_path), 'application/zstd',
+                                  existing, retries)
+        if not ok:
+            return False
+        raw_name = os.path.basename(file_path)
+        if f"{raw_name}.gz" in existing:
+            trash_drive_file(service, f"{raw_name}.gz", existing, retries)
+        if UPLOAD_RAW_DB:
+            ok = upload_file_to_drive(service, src_path, raw_name, 'application/x-sqlite3', existing, retries)
+        elif raw_name in existing:
+            trash_drive_file(service, raw_name, existing, retries)
+        return ok
+    finally:
+        if os.path.exists(zst_path):
+            os.remove(zst_path)
+        if snapshot:
+            os.remove(snapshot)
+
+def upload_in_background(file_path, existing, snapshot=None):
+    """背景上傳用：取得目前執行緒自己的 service (同一執行緒的後續上傳沿用)"""
+    service = get_drive_service()
+    if service is None:
+        print(f"❌ 無法建立上傳用 Drive 服務: {file_path}")
+        if snapshot:
+            os.remove(snapshot)
+        return False
+    return upload_db_to_drive(service, file_path, existing, snapshot=snapshot)
+
+def check_needs_update(conn):
     try:
-        conn = sqlite3.connect(db_path)
         res = conn.execute("SELECT MAX(date) FROM stock_prices").fetchone()
-        conn.close()
         db_latest_date = res[0] if res and res[0] else None
         if not db_latest_date: return True
         # 只要最新日期小於當前日期，就更新（但在 run_sync 會被限制在 2025）
         today_str = datetime.now().strftime('%Y-%m-%d')
         return db_latest_date < today_str
-    except: return True
+    except sqlite3.Error: return True
+
+def get_daily_stats(conn, date):
+    """單日筆數與總成交量，直接交給 SQLite 聚合 (date 為主鍵前綴，走索引)"""
+    rows, volume = conn.execute(
+        "SELECT COUNT(*), SUM(volume) FROM stock_prices WHERE date = ?", (date,)).fetchone()
+    return rows, volume or 0
 
-def get_db_summary(db_path, market_id, fail_list=None):
-    if not os.path.exists(db_path): return None
+def get_db_summary(conn, market_id, fail_list=None):
     try:
-        conn = sqlite3.connect(db_path)
-        df_stats = pd.read_sql("SELECT COUNT(DISTINCT symbol) as s, MAX(date) as d2, COUNT(*) as t FROM stock_prices", conn)
+        # 💡 統計全在 SQL 內聚合，不必經過 DataFrame：
+        # 依 symbol 分組走 (symbol, date) 覆蓋索引，一次掃描同時得到檔數與總筆數 (不需暫存 B-tree)；
+        # MAX(date) 單獨查詢才能用主鍵索引直接取最後一筆
+        success_count, total_rows = conn.execute(
+            "SELECT COUNT(*), SUM(n) FROM (SELECT COUNT(*) AS n FROM stock_prices GROUP BY symbol)").fetchone()
+        latest_date = conn.execute("SELECT MAX(date) FROM stock_prices").fetchone()[0]
         info_count = conn.execute("SELECT COUNT(*) FROM stock_info").fetchone()[0]
-        conn.close()
-
-        success_count = int(df_stats['s'][0]) if df_stats['s'][0] else 0
-        latest_date = df_stats['d2'][0] if df_stats['d2'][0] else "N/A"
-        total_rows = int(df_stats['t'][0]) if df_stats['t'][0] else 0
+        total_rows = total_rows or 0
+        latest_rows = get_daily_stats(conn, latest_date)[0] if latest_date else 0
+        latest_date = latest_date or "N/A"
         
         expected = EXPECTED_MIN_STOCKS.get(market_id, 1)
         coverage = (success_count / expected) * 100
@@ -129,6 +301,7 @@ def get_db_summary(db_path, market_id, fail_list=None):
         return {
             "market": market_id.upper(), "expected": expected, "success": success_count,
             "coverage": f"{coverage:.1f}%", "end_date": latest_date, "total_rows": total_rows,
+            "latest_rows": latest_rows,
             "names_synced": info_count, "fail_list": fail_list if fail_list else [],
             "status": "✅" if coverage >= 80 else "⚠️"
         }
@@ -138,62 +311,106 @@ def get_db_summary(db_path, market_id, fail_list=None):
 
 # ========== [主流程] ==========
 
-def main():
-    target_market = sys.argv[1].lower() if len(sys.argv) > 1 else None
-    module_map = {
-        'tw': downloader_tw, 'us': downloader_us, 'cn': downloader_cn,
-        'hk': downloader_hk, 'jp': downloader_jp, 'kr': downloader_kr
-    }
+MODULE_MAP = {
+    'tw': downloader_tw, 'us': downloader_us, 'cn': downloader_cn,
+    'hk': downloader_hk, 'jp': downloader_jp, 'kr': downloader_kr
+}
+
+def run_market(m, drive_files):
+    """
+    單一市場的完整流程 (在子行程執行)：雲端還原 -> 同步 -> 特徵加工 -> 摘要 -> 上傳快照。
+    回傳 (market, summary, snapshot)；snapshot 為待上傳的快照路徑，不需上傳時為 None。
+    """
+    db_file = f"{m}_stock_warehouse.db"
+    print(f"\n--- 🌍 市場啟動: {m.upper()} ---")
+
+    if drive_files is not None and not os.path.exists(db_file):
+        service = get_drive_service()
+        if service:
+            download_db_from_drive(service, db_file, drive_files)
+
+    # 💡 同一市場的檢查、摘要、上傳前快照共用一條連線 (warehouse_core 快取)
+    needs_update = check_needs_update(get_conn(db_file)) if os.path.exists(db_file) else True
+    execution_results = {"has_changed": False, "fail_list": []}
     
-    markets_to_run = [target_market] if target_market in module_map else list(module_map.keys())
-    service = get_drive_service()
-    all_summaries = []
+    if needs_update:
+        target_module = MODULE_MAP.get(m)
+        # 💡 關鍵修正：傳送強制日期給下載模組
+        print(f"📡 執行同步: 範圍設定為 {FORCE_START_DATE} ~ {FORCE_END_DATE}")
+        execution_results = target_module.run_sync(
+            start_date=FORCE_START_DATE, 
+            end_date=FORCE_END_DATE,
+            max_workers=8
+        ) 
+    
+    # 執行特徵加工
+    if process_market_data and os.path.exists(db_file):
+        print(f"🧪 執行特徵工程加工...")
+        try:
+            process_market_data(db_file)
+        except Exception as e:
+            print(f"❌ 特徵加工出錯: {e}")
 
-    for m in markets_to_run:
-        db_file = f"{m}_stock_warehouse.db"
-        print(f"\n--- 🌍 市場啟動: {m.upper()} ---")
+    has_changed = execution_results.get('has_changed', False) if isinstance(execution_results, dict) else False
+    current_fails = execution_results.get('fail_list', []) if isinstance(execution_results, dict) else []
+    
+    summary = get_db_summary(get_conn(db_file), m, fail_list=current_fails) if os.path.exists(db_file) else None
 
-        if service and not os.path.exists(db_file):
-            download_db_from_drive(service, db_file)
+    # 💡 只有股價確實寫入 (或雲端還沒有這個 DB) 才上傳：
+    # 假日/無新資料時同步流程仍會改寫清單日期、empty_runs 與統計，檔案 md5 必然不同，
+    # 不能靠 md5 比對省下這次上傳；清單異動留待下次有新股價時一併上傳
+    on_drive = drive_files is not None and any(f"{db_file}{ext}" in drive_files for ext in ("", ".zst", ".gz"))
+    snapshot = None
+    if drive_files is not None and (has_changed or not on_drive) and os.path.exists(db_file):
+        try:
+            # 💡 上傳快照 (Backup API 或 VACUUM INTO)：已併入 WAL 並改回 rollback journal，也不影響使用中的 DB
+            snapshot = make_snapshot(get_conn(db_file), db_file)
+        except Exception as e:
+            print(f"❌ 快照建立失敗: {e}")
+    close_conn(db_file)
+    return m, summary, snapshot
 
-        needs_update = check_needs_update(db_file)
-        execution_results = {"has_changed": False, "fail_list": []}
-        
-        if needs_update:
-            target_module = module_map.get(m)
-            # 💡 關鍵修正：傳送強制日期給下載模組
-            print(f"📡 執行同步: 範圍設定為 {FORCE_START_DATE} ~ {FORCE_END_DATE}")
-            execution_results = target_module.run_sync(
-                start_date=FORCE_START_DATE, 
-                end_date=FORCE_END_DATE,
-                max_workers=8
-            ) 
-        
-        # 執行特徵加工
-        if process_market_data and os.path.exists(db_file):
-            print(f"🧪 執行特徵工程加工...")
+def main():
+    target_market = sys.argv[1].lower() if len(sys.argv) > 1 else None
+    markets_to_run = [target_market] if target_market in MODULE_MAP else list(MODULE_MAP.keys())
+    service = get_drive_service()
+    # 💡 雲端檔案清單整次執行只查一次 (本次各市場的 DB 與其壓縮版)
+    drive_names = [f"{m}_stock_warehouse.db{ext}" for m in markets_to_run for ext in ("", ".zst", ".gz")]
+    drive_files = list_drive_files(service, drive_names) if service else None
+    if service and drive_files is None:
+        print("⚠️ 無法讀取雲端檔案清單，本次略過雲端同步")
+    summaries = {}
+    # 💡 各市場 DB、資料來源皆獨立，以子行程並行同步
+    # (yfinance 批次下載非執行緒安全，但各行程各有一份狀態；spawn 避免複製父行程的 Drive 連線)
+    # ⚠️ 限流狀態透過 initializer 跨行程共用，並行不會放大對 Yahoo 的請求頻率
+    # 上傳仍在父行程的背景執行緒進行，與其他市場的同步重疊
+    upload_pool = ThreadPoolExecutor(max_workers=len(markets_to_run))
+    uploads = {}
+    mp_ctx = multiprocessing.get_context("spawn")
+
+    with ProcessPoolExecutor(max_workers=min(MAX_MARKET_WORKERS, len(markets_to_run)), mp_context=mp_ctx,
+                             initializer=share_rate_limit,
+                             initargs=(mp_ctx.Lock(), mp_ctx.Value('d', 0.0, lock=False))) as market_pool:
+        futures = [market_pool.submit(run_market, m, drive_files) for m in markets_to_run]
+        for future in as_completed(futures):
             try:
-                process_market_data(db_file)
+                m, summary, snapshot = future.result()
             except Exception as e:
-                print(f"❌ 特徵加工出錯: {e}")
+                print(f"❌ 市場同步失敗: {e}")
+                continue
+            summaries[m] = summary
+            if snapshot:
+                print(f"🔄 執行雲端同步中 (背景上傳): {m.upper()}")
+                db_file = f"{m}_stock_warehouse.db"
+                uploads[db_file] = upload_pool.submit(upload_in_background, db_file, drive_files, snapshot)
 
-        has_changed = execution_results.get('has_changed', False) if isinstance(execution_results, dict) else False
-        current_fails = execution_results.get('fail_list', []) if isinstance(execution_results, dict) else []
-        
-        summary = get_db_summary(db_file, m, fail_list=current_fails)
-        if summary:
-            all_summaries.append(summary)
+    upload_pool.shutdown(wait=True)
+    for db_file, future in uploads.items():
+        if future.exception():
+            print(f"❌ 上傳失敗 {db_file}: {future.exception()}")
 
-        # 只要有執行過更新或資料變動就同步雲端
-        if service and (has_changed or needs_update):
-            print(f"🔄 執行雲端同步中...")
-            try:
-                conn = sqlite3.connect(db_file)
-                conn.execute("VACUUM")
-                conn.close()
-                upload_db_to_drive(service, db_file)
-            except Exception as e:
-                print(f"❌ 優化或上傳失敗: {e}")
+    # 報告依市場原始順序排列
+    all_summaries = [summaries[m] for m in markets_to_run if summaries.get(m)]
 
     # 💡 保留 Notifier 發送功能
     if notifier and all_summaries:
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import os, requests, resend
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+
+TZ8 = timezone(timedelta(hours=8))  # 台北時間 (UTC+8)
 
 class StockNotifier:
     def __init__(self):
@@ -13,8 +15,7 @@ class StockNotifier:
 
     def get_now_time_str(self):
         """獲獲台北時間 (UTC+8)"""
-        now_utc8 = datetime.utcnow() + timedelta(hours=8)
-        return now_utc8.strftime("%Y-%m-%d %H:%M:%S")
+        return datetime.now(TZ8).strftime("%Y-%m-%d %H:%M:%S")
 
     def send_telegram(self, message):
         """發送 Telegram 即時通知 (支援 HTML 格式)"""
@@ -45,7 +46,8 @@ class StockNotifier:
         3. 獨立發送 Email (受 Key 檢查保護)
         """
         report_time = self.get_now_time_str()
-        market_sections = ""
+        # 💡 各市場區塊先收集成 list，最後一次 join，不在迴圈內反覆串接整段 HTML
+        section_list = []
         tg_brief_list = []
 
         # --- 數據解析與建構 ---
@@ -57,19 +59,19 @@ class StockNotifier:
             fail_count_text = f"...等其餘 {len(fail_list)-20} 檔" if len(fail_list) > 20 else ""
 
             # Email HTML 區塊構建
-            market_sections += f"""
+            section_list.append(f"""
             <div style="margin-bottom: 30px; border: 1px solid #ddd; padding: 20px; border-radius: 12px; background-color: #fff;">
                 <h2 style="margin-top: 0; color: #333; font-size: 18px;">{s['market']} 數據報告</h2>
                 <div style="font-size: 14px; color: #444;">
                     <b>更新覆蓋率:</b> <span style="font-size: 18px; font-weight: bold; background-color: #fff3cd;">{s['coverage']}</span><br>
                     <b>成功/應收:</b> {s['success']} / {s['expected']} ({success_rate:.1f}%)<br>
-                    <b>最新日期:</b> {s['end_date']} | <b>總筆數:</b> {s['total_rows']:,}<br>
+                    <b>最新日期:</b> {s['end_date']} ({s.get('latest_rows', 0):,} 檔) | <b>總筆數:</b> {s['total_rows']:,}<br>
                     <div style="margin-top: 10px; color: #dc3545; font-size: 12px;">
                         <b>異常摘要:</b> {fail_summary} {fail_count_text}
                     </div>
                 </div>
             </div>
-            """
+            """)
 
             # Telegram 文本構建
             tg_market_msg = (
@@ -80,6 +82,8 @@ class StockNotifier:
             )
             tg_brief_list.append(tg_market_msg)
 
+        market_sections = "".join(section_list)
+
         # --- 第一階段：發送 Telegram (最高優先權) ---
         final_tg_msg = f"📉 <b>全球數據倉儲同步總結</b>\n\n" + "\n\n---\n\n".join(tg_brief_list)
         tg_ok = self.send_telegram(final_tg_msg)
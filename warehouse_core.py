@@ -0,0 +1,614 @@
+# -*- coding: utf-8 -*-
+"""
+warehouse_core.py
+-----------------
+各市場下載器共用的 SQLite 寫入工具
+
+✔ 單一寫入執行緒：下載迴圈只負責網路 I/O，寫入集中在同一條連線
+✔ 共用 HTTP Session：清單下載重用連線並自動重試
+✔ 執行緒長連線：清單、查詢與維護共用同一條連線，不再反覆開關
+✔ WAL + synchronous=NORMAL：降低每次 commit 的 fsync 成本 (所有連線統一套用)
+✔ 批次提交：累積約 1 萬筆或約 2 秒才 commit 一次
+✔ 批次下載：一次 yfinance 請求多檔，由 yfinance 內建多執行緒展開
+✔ 增量同步：依資料庫內各檔最後日期決定起抓日，並重疊最後幾天以修正盤中未收盤的 K 棒
+✔ 代號索引：(symbol, date) 次要索引加速增量查詢，冷模式大量寫入後才重建
+✔ 清單快取：同一天內重跑直接沿用資料庫中的清單 (僅限上次清單完整同步)
+✔ 略過死代號：連續多次抓不到任何資料的代號 (下市/停牌) 熱模式暫停請求，每週重新探測一次
+✔ 統一建庫：六個市場共用同一份資料表結構與建庫 PRAGMA
+✔ 統一同步流程：批次下載、補抓、寫入與維護集中在 sync_prices，下載器只負責清單
+"""
+
+import atexit, os, queue, sqlite3, threading, time
+import requests
+import numpy as np
+import pandas as pd
+import yfinance as yf
+from tqdm import tqdm
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+# ========== 1. 參數設定 ==========
+WRITER_QUEUE_SIZE = 64        # 佇列上限，避免下載端跑太快撐爆記憶體
+WRITER_COMMIT_ROWS = 10000    # 累積多少筆才 commit 一次
+WRITER_COMMIT_SECONDS = 2.0   # 交易最長開啟秒數，下載較慢時也會定期落盤
+WRITER_AUTOCHECKPOINT = 10000 # 寫入執行緒的 WAL 自動 checkpoint 頁數 (一般連線沿用 1000)
+YF_BATCH_SIZE = 50            # 每次 yfinance 請求的代號數
+YF_BATCH_DELAY = 1.0          # 兩次批次請求的最小間隔秒數，避免被 Yahoo 限流
+DEAD_SYMBOL_RUNS = 3          # 連續幾次同步都沒資料就視為死代號
+DEAD_SYMBOL_RETRY_DAYS = 7    # 死代號距上次嘗試超過幾天就再探測一次 (例如剛上市、Yahoo 尚未收錄)
+YF_TRANSIENT_RETRIES = 2      # 逾時/斷線時整批重試的次數 (指數退避)
+INCREMENTAL_OVERLAP_DAYS = 2  # 增量起抓日往前重疊的天數：盤中抓到的未收盤 K 棒下次會被重抓覆蓋
+# 💡 只有網路逾時/斷線值得重試；HTTPError (4xx)、TooManyRedirects 等永久錯誤直接交由補抓
+# ⚠️ 不可直接列 OSError：requests 的所有例外 (含 HTTPError) 都繼承 OSError
+try:
+    # 新版 yfinance 走 curl_cffi，其逾時/斷線例外不屬於 requests 也不屬於內建 ConnectionError
+    from curl_cffi.requests import exceptions as _curl_exceptions
+    _CURL_TRANSIENT_ERRORS = (_curl_exceptions.Timeout, _curl_exceptions.ConnectionError)
+except (ImportError, AttributeError):
+    _CURL_TRANSIENT_ERRORS = ()
+TRANSIENT_ERRORS = (requests.Timeout, requests.ConnectionError,
+                    ConnectionError, TimeoutError) + _CURL_TRANSIENT_ERRORS
+PRICE_COLUMNS = ['date', 'symbol', 'open', 'high', 'low', 'close', 'volume']
+
+# 💡 固定字串常數：sqlite3 的 statement cache 以 SQL 字串為鍵，同一連線只需編譯一次
+# 主鍵衝突 (重抓到已入庫的日期) 時就地更新價量，不像 OR REPLACE 先刪整列再重插、動兩次索引
+# 價量完全相同的重疊日期不更新，changes() 不計入，假日重跑不會被誤判為有新資料
+INSERT_PRICE_SQL = ("INSERT INTO stock_prices (date, symbol, open, high, low, close, volume) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(date, symbol) DO UPDATE SET open = excluded.open, high = excluded.high, "
+                    "low = excluded.low, close = excluded.close, volume = excluded.volume "
+                    "WHERE open IS NOT excluded.open OR high IS NOT excluded.high OR low IS NOT excluded.low "
+                    "OR close IS NOT excluded.close OR volume IS NOT excluded.volume")
+# 💡 每條連線都套用：WAL + NORMAL 降低 fsync，暫存放記憶體，加大頁快取並啟用 mmap
+CONNECTION_PRAGMAS = ("PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY; "
+                      "PRAGMA cache_size=-65536; PRAGMA mmap_size=268435456; PRAGMA wal_autocheckpoint=1000;")
+
+# ⚠️ stock_info 用 upsert 而非 INSERT OR REPLACE，否則每次更新清單都會把 empty_runs 歸零
+INSERT_INFO_SQL = ("INSERT INTO stock_info (symbol, name, sector, market, updated_at) "
+                   "VALUES (?, ?, ?, ?, ?) "
+                   "ON CONFLICT(symbol) DO UPDATE SET name = excluded.name, sector = excluded.sector, "
+                   "market = excluded.market, updated_at = excluded.updated_at")
+
+def log(msg: str):
+    print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}", flush=True)
+
+def _build_session():
+    """清單下載共用的 HTTP Session：連線重用 (keep-alive)，暫時性錯誤自動退避重試"""
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET",))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'Accept-Encoding': 'gzip, deflate',
+    })
+    return session
+
+# 💡 同一個行程只做一次 TCP/TLS 握手，清單來源的多次請求共用連線
+SESSION = _build_session()
+
+def text_column(df, col, default='Unknown'):
+    """清單解析用：取出文字欄並去除空白 (向量化)，欄位不存在時整欄填入 default"""
+    if col not in df.columns:
+        return pd.Series(default, index=df.index)
+    return df[col].astype(str).str.strip()
+
+# ========== 2. 執行緒長連線 ==========
+def connect(db_path, **kwargs):
+    """開啟連線並套用 CONNECTION_PRAGMAS"""
+    conn = sqlite3.connect(db_path, timeout=60, **kwargs)
+    conn.executescript(CONNECTION_PRAGMAS)
+    return conn
+
+_tls = threading.local()
+_all_conns = []
+_all_conns_lock = threading.Lock()
+
+def get_conn(db_path):
+    """取得目前執行緒對 db_path 的長連線，第一次呼叫時才建立"""
+    # 相對/絕對路徑指向同一檔案時共用同一條連線 (main.py 用相對路徑、下載器用絕對路徑)
+    db_path = os.path.abspath(db_path)
+    conns = getattr(_tls, 'conns', None)
+    if conns is None:
+        conns = _tls.conns = {}
+    conn = conns.get(db_path)
+    if conn is None:
+        # check_same_thread=False 只為了讓 atexit 能收尾，平常仍只在建立它的執行緒使用
+        conn = connect(db_path, check_same_thread=False)
+        conns[db_path] = conn
+        with _all_conns_lock:
+            _all_conns.append(conn)
+    return conn
+
+def close_conn(db_path):
+    """
+    關閉目前執行緒對 db_path 的長連線。
+    ⚠️ 同步結束、上傳 DB 之前必須呼叫：最後一條連線關閉時 WAL 才會完整寫回主檔。
+    """
+    conns = getattr(_tls, 'conns', {})
+    conn = conns.pop(os.path.abspath(db_path), None)
+    if conn is not None:
+        conn.close()
+
+@atexit.register
+def _close_all_conns():
+    with _all_conns_lock:
+        for conn in _all_conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        _all_conns.clear()
+
+# ========== 3. 單一寫入執行緒 ==========
+class PriceWriter:
+    """
+    背景寫入 stock_prices：
+    下載端呼叫 put(df) 後立即返回，由唯一的寫入執行緒持有連線並批次 commit。
+    寫入或提交失敗的代號記在 failed_symbols，結束後由呼叫端計入失敗清單。
+    """
+
+    def __init__(self, db_path, commit_rows=WRITER_COMMIT_ROWS, commit_seconds=WRITER_COMMIT_SECONDS):
+        self.db_path = db_path
+        self.commit_rows = commit_rows
+        self.commit_seconds = commit_seconds
+        self.queue = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+        self.rows_written = 0
+        self.errors = 0
+        self.failed_symbols = set()
+        self._tx_symbols = set()  # 目前交易中已寫入的代號，提交失敗時整批視為失敗
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def put(self, df):
+        self._put(df)
+
+    def close(self):
+        """送出結束訊號並等待所有資料落盤"""
+        try:
+            self._put(None)
+        except RuntimeError:
+            pass  # 寫入執行緒已結束，沒有資料需要等待
+        self._thread.join()
+
+    def _put(self, item):
+        # ⚠️ 限時放入並檢查寫入執行緒是否還活著，避免執行緒意外結束後佇列滿了永遠卡住
+        while self._thread.is_alive():
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise RuntimeError("寫入執行緒已停止，無法再寫入資料")
+
+    def _commit(self, conn, pending):
+        """提交目前交易；失敗就 ROLLBACK 並計入錯誤，寫入執行緒繼續消化佇列"""
+        try:
+            conn.execute("COMMIT")
+            self.rows_written += pending
+        except Exception as e:
+            self.errors += 1
+            self.failed_symbols |= self._tx_symbols
+            log(f"⚠️ 提交失敗，已捨棄本次交易 ({pending} 筆): {e}")
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass  # 交易可能已被 SQLite 自動回滾
+        self._tx_symbols = set()
+
+    def _run(self):
+        # isolation_level=None：交易邊界由下方明確的 BEGIN IMMEDIATE / COMMIT 控制
+        conn = connect(self.db_path, isolation_level=None)
+        # 💡 大量寫入期間放寬自動 checkpoint，WAL 回寫主檔 (與 fsync) 集中成較少次
+        conn.execute(f"PRAGMA wal_autocheckpoint={WRITER_AUTOCHECKPOINT}")
+        pending = 0
+        in_tx = False
+        tx_started = 0.0
+        try:
+            while True:
+                try:
+                    # 交易開啟中就限時等待，佇列閒置時也能按時 commit
+                    df = self.queue.get(timeout=self.commit_seconds if in_tx else None)
+                except queue.Empty:
+                    df = False
+                if df is None:
+                    break
+                try:
+                    if df is not False:
+                        if not in_tx:
+                            # 一開始就取得寫鎖，避免交易中途才升級鎖而與其他連線互等
+                            conn.execute("BEGIN IMMEDIATE")
+                            in_tx = True
+                            tx_started = time.monotonic()
+                        # 💡 直接 executemany，繞過 to_sql 的 SQL 產生與逐列轉換
+                        # 以 total_changes 計數：重疊日期價量未變的列不算寫入
+                        changes_before = conn.total_changes
+                        conn.executemany(INSERT_PRICE_SQL, df[PRICE_COLUMNS].itertuples(index=False, name=None))
+                        pending += conn.total_changes - changes_before
+                        self._tx_symbols.update(df['symbol'].unique())
+                except Exception as e:
+                    # 💡 單批失敗不中斷寫入執行緒，否則下載端會卡在滿的佇列
+                    self.errors += 1
+                    self.failed_symbols.update(df['symbol'].unique())
+                    log(f"⚠️ 寫入失敗: {e}")
+
+                if in_tx and (pending >= self.commit_rows
+                              or time.monotonic() - tx_started >= self.commit_seconds):
+                    self._commit(conn, pending)
+                    in_tx = False
+                    pending = 0
+            if in_tx:
+                self._commit(conn, pending)
+        finally:
+            conn.close()
+
+# ========== 4. yfinance 批次下載 ==========
+class _RequestClock:
+    """單一行程時的上次請求時間 (介面同 multiprocessing.Value，可直接替換成跨行程共用版)"""
+    value = 0.0
+
+_rate_lock = threading.Lock()
+_last_request_at = _RequestClock()
+
+def share_rate_limit(lock, last_request_at):
+    """
+    多個市場以子行程並行同步時，由 ProcessPoolExecutor 的 initializer 呼叫，
+    讓所有行程共用同一把鎖與上次請求時間，整體對 Yahoo 的請求頻率仍受 YF_BATCH_DELAY 限制。
+    lock: multiprocessing.Lock；last_request_at: multiprocessing.Value('d')
+    """
+    global _rate_lock, _last_request_at
+    _rate_lock, _last_request_at = lock, last_request_at
+
+def _wait_rate_limit():
+    """
+    確保兩次批次請求至少間隔 YF_BATCH_DELAY 秒。
+    💡 以上次請求時間計算，處理結果與寫入佇列的時間也算在間隔內，
+       不再於每批結束後固定 sleep。
+    ⚠️ 用 time.time() 而非 monotonic：跨行程共用時各行程的時鐘必須一致
+    """
+    with _rate_lock:
+        wait = _last_request_at.value + YF_BATCH_DELAY - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        _last_request_at.value = time.time()
+
+def _to_date_str(values):
+    """日期欄轉為 'YYYY-MM-DD' 字串 (向量化)"""
+    dates = pd.to_datetime(values)   # yfinance 已是 datetime64，這裡幾乎零成本
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_localize(None)  # 保留交易所當地日期
+    # 💡 numpy 直接截斷到「日」再轉字串，取代逐筆 strftime
+    return dates.values.astype('datetime64[D]').astype(str)
+
+def normalize_ohlcv(df, db_symbol):
+    """將 yfinance 單檔結果轉為 stock_prices 欄位格式"""
+    # reset_index 已產生新物件，之後直接原地加欄位，不再額外 .copy()
+    df = df.reset_index()
+    df.columns = [str(c).lower() for c in df.columns]
+
+    date_col = 'date' if 'date' in df.columns else df.columns[0]
+    df['date'] = _to_date_str(df[date_col])
+    df['symbol'] = db_symbol
+    return df[PRICE_COLUMNS]
+
+def _split_multi(data, symbol_map):
+    """
+    將 group_by='ticker' 的多檔結果一次轉為長表，再依代號切開。
+    💡 整批只做一次 stack / 日期轉換，不再逐檔 reset_index 與轉日期。
+    """
+    tickers = set(data.columns.get_level_values(0))
+    present = [s for s in symbol_map if s in tickers]
+    if not present:
+        return {}
+
+    df = data[present].stack(level=0, future_stack=True)
+    df.index.names = ['date', 'yf_symbol']
+    df = df.reset_index()
+    df.columns = [str(c).lower() for c in df.columns]
+
+    # 多檔合併後的日期是聯集，該檔沒有交易的日期整列都是 NaN
+    df = df.dropna(subset=['open', 'high', 'low', 'close', 'volume'], how='all')
+    if df.empty:
+        return {}
+    df['date'] = _to_date_str(df['date'])
+    df['symbol'] = df['yf_symbol'].map(symbol_map)
+    return {db_sym: g[PRICE_COLUMNS] for db_sym, g in df.groupby('symbol', sort=False)}
+
+def download_batch(symbol_map, start_date, end_date=None, threads=True, timeout=30):
+    """
+    一次請求多檔股價。
+    symbol_map: {yfinance 代號: 資料庫代號}
+    回傳 {資料庫代號: DataFrame}，沒有資料的代號不會出現在結果中。
+    💡 只在單一呼叫端使用：yfinance 在同一次 download 內自行多執行緒，
+       不可由多個執行緒同時呼叫 yf.download，否則會發生記憶體錯亂。
+    """
+    for attempt in range(YF_TRANSIENT_RETRIES + 1):
+        _wait_rate_limit()
+        try:
+            data = yf.download(list(symbol_map), start=start_date, end=end_date, group_by='ticker',
+                               progress=False, auto_adjust=True, threads=threads, timeout=timeout)
+            break
+        except TRANSIENT_ERRORS as e:
+            if attempt == YF_TRANSIENT_RETRIES:
+                log(f"⚠️ 批次下載逾時/斷線，已重試 {attempt} 次仍失敗: {e}")
+                return {}
+            wait = 2 ** (attempt + 1)
+            log(f"⚠️ 批次下載逾時/斷線，{wait} 秒後重試: {e}")
+            time.sleep(wait)
+        except Exception as e:
+            # 非暫時性錯誤 (yfinance 各版本的例外型別不一)，重試也沒用，交由呼叫端補抓
+            log(f"⚠️ 批次下載失敗: {e}")
+            return {}
+
+    if data is None or data.empty:
+        return {}
+
+    try:
+        if isinstance(data.columns, pd.MultiIndex):
+            return _split_multi(data, symbol_map)
+        if len(symbol_map) == 1:
+            db_sym = next(iter(symbol_map.values()))
+            df = data.dropna(how='all')
+            return {db_sym: normalize_ohlcv(df, db_sym)} if not df.empty else {}
+    except (KeyError, ValueError) as e:
+        # 欄位缺漏等異常交由呼叫端補抓
+        log(f"⚠️ 批次結果解析失敗: {e}")
+    return {}
+
+def retry_missing(symbol_map, results, skip, start_date, end_date=None):
+    """
+    批次中缺漏的代號再整批重試一次 (單執行緒)，結果直接併入 results。
+    skip: 不需重試的資料庫代號 (例如已有歷史、只是增量區間沒資料)
+    """
+    missing = {y: d for y, d in symbol_map.items() if d not in results and d not in skip}
+    if missing:
+        results.update(download_batch(missing, start_date, end_date, threads=False))
+    return results
+
+# ========== 5. 增量同步 ==========
+def load_last_dates(db_path):
+    """一次查出所有代號的最後交易日 {symbol: 'YYYY-MM-DD'}"""
+    return dict(get_conn(db_path).execute("SELECT symbol, MAX(date) FROM stock_prices GROUP BY symbol"))
+
+def incremental_start(symbols, last_dates, start_date):
+    """
+    批次起抓日：批內各檔「最後日期 - INCREMENTAL_OVERLAP_DAYS 天」的最小值，且不早於 start_date。
+    批內只要有一檔沒有資料就從 start_date 起抓。
+    ⚠️ 排程執行時亞股多半仍在盤中，最後一根 K 棒可能未收盤；
+       起抓日與已入庫日期重疊，重抓的 K 棒交由 upsert 覆蓋修正。
+    """
+    lasts = [last_dates.get(symbol) for symbol in symbols]
+    if None in lasts:
+        return start_date
+
+    # 💡 numpy 直接做日期減法與取最小值，不必逐檔建立 Timestamp 再 strftime
+    overlap_date = str((np.array(lasts, dtype='datetime64[D]') - INCREMENTAL_OVERLAP_DAYS).min())
+    return max(start_date, overlap_date)
+
+# 💡 PRIMARY KEY 是 (date, symbol)，依代號查詢 (MAX(date) GROUP BY symbol 等) 需要另一個索引
+SYMBOL_INDEX_SQL = "CREATE INDEX IF NOT EXISTS idx_prices_symbol_date ON stock_prices (symbol, date)"
+
+def defer_symbol_index(db_path):
+    """冷模式/首次建庫大量寫入前先移除次要索引，寫完再一次建立，省去逐筆維護 B-tree"""
+    get_conn(db_path).execute("DROP INDEX IF EXISTS idx_prices_symbol_date")
+
+def ensure_symbol_index(db_path):
+    get_conn(db_path).execute(SYMBOL_INDEX_SQL)
+
+def drop_known_rows(results, last_dates):
+    """
+    批次起抓日取的是批內最小值，進度較新的代號會多抓到已入庫的日期；
+    寫入前先濾掉較舊的日期，避免大量主鍵衝突。整檔都是舊資料就從 results 移除。
+    ⚠️ 最後日期當天保留：可能是盤中未收盤的 K 棒，需交由 upsert 覆蓋修正。
+    """
+    for db_sym, df in list(results.items()):
+        last = last_dates.get(db_sym)
+        if last is None:
+            continue
+        df = df[df['date'] >= last]
+        if df.empty:
+            del results[db_sym]
+        else:
+            results[db_sym] = df
+    return results
+
+# ========== 6. 同步後維護 ==========
+def maintain_db(conn, full_vacuum=False):
+    """
+    同步後的資料庫維護：
+    - 指定 full_vacuum 或空頁超過 1/4 才完整 VACUUM (會重寫整個檔案)
+    - 平常只回收空頁、更新統計
+    - 最後把 WAL 寫回主檔並截斷，上傳的 .db 即為完整資料
+    """
+    freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    pages = conn.execute("PRAGMA page_count").fetchone()[0]
+    if full_vacuum or freelist > pages // 4:
+        log(f"🧹 執行資料庫完整 VACUUM (空頁 {freelist}/{pages})...")
+        # 同一連線先設定增量回收，VACUUM 時一併把舊 DB 轉換過去
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    else:
+        # 💡 日常只回收空頁並更新統計，避免每次重寫整個 DB
+        log("🧹 執行資料庫維護 (incremental_vacuum + optimize)...")
+        conn.executescript("PRAGMA incremental_vacuum(1000); PRAGMA optimize;")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+# ========== 7. 清單快取 ==========
+# sync_meta 中記錄「清單完整同步日期」的鍵
+LIST_SYNCED_KEY = 'list_synced_at'
+
+def load_cached_list(db_path):
+    """
+    今天已完整同步過清單就直接沿用 stock_info 的 [(symbol, name)]，否則回傳空 list。
+    💡 各交易所清單一天最多變動一次，同日重跑不必再下載與解析。
+    ⚠️ 只認 save_stock_list 留下的完成標記：部分分頁失敗的清單同日重跑仍會重新下載，
+       不會沿用殘缺清單而漏掉代號。
+    """
+    today_str = pd.Timestamp.now().strftime('%Y-%m-%d')
+    conn = get_conn(db_path)
+    synced = conn.execute("SELECT value FROM sync_meta WHERE key = ?", (LIST_SYNCED_KEY,)).fetchone()
+    if not synced or synced[0] != today_str:
+        return []
+    return conn.execute("SELECT symbol, name FROM stock_info WHERE updated_at = ?", (today_str,)).fetchall()
+
+def save_stock_list(db_path, info_rows, complete=True):
+    """
+    清單寫入 stock_info (整份一次 executemany + 單次 commit)。
+    complete: 清單是否完整 (所有來源都成功)；完整才寫入今日完成標記，否則清除標記。
+    """
+    today_str = pd.Timestamp.now().strftime('%Y-%m-%d')
+    conn = get_conn(db_path)
+    with conn:
+        conn.executemany(INSERT_INFO_SQL, info_rows)
+        if complete:
+            conn.execute("INSERT INTO sync_meta (key, value) VALUES (?, ?) "
+                         "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (LIST_SYNCED_KEY, today_str))
+        else:
+            conn.execute("DELETE FROM sync_meta WHERE key = ?", (LIST_SYNCED_KEY,))
+
+# ========== 8. 死代號過濾 ==========
+def load_dead_symbols(db_path):
+    """
+    連續 DEAD_SYMBOL_RUNS 次同步都沒有抓到任何資料的代號。
+    💡 上次嘗試已超過 DEAD_SYMBOL_RETRY_DAYS 天的不算在內，讓它們定期重新探測，不會永久封鎖。
+    """
+    retry_before = (pd.Timestamp.now() - pd.Timedelta(days=DEAD_SYMBOL_RETRY_DAYS)).strftime('%Y-%m-%d')
+    return {s for (s,) in get_conn(db_path).execute(
+        "SELECT symbol FROM stock_info WHERE empty_runs >= ? AND empty_checked > ?",
+        (DEAD_SYMBOL_RUNS, retry_before))}
+
+def record_empty_runs(db_path, empty_symbols, fetched_symbols):
+    """沒抓到資料的代號計數 +1 並記下嘗試日期，有抓到的歸零"""
+    today_str = pd.Timestamp.now().strftime('%Y-%m-%d')
+    conn = get_conn(db_path)
+    with conn:
+        conn.executemany("UPDATE stock_info SET empty_runs = empty_runs + 1, empty_checked = ? WHERE symbol = ?",
+                         [(today_str, s) for s in empty_symbols])
+        conn.executemany("UPDATE stock_info SET empty_runs = 0 WHERE symbol = ? AND empty_runs > 0",
+                         [(s,) for s in fetched_symbols])
+
+# ========== 9. 資料庫初始化 ==========
+# stock_info 後來才新增的欄位：舊版 DB 開啟時補上
+INFO_UPGRADE_COLUMNS = {'market': "TEXT", 'empty_runs': "INTEGER DEFAULT 0", 'empty_checked': "TEXT"}
+
+def ensure_info_columns(conn):
+    """舊版 DB 升級：補上 stock_info 後來新增的欄位"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(stock_info)")}
+    for name, decl in INFO_UPGRADE_COLUMNS.items():
+        if name not in columns:
+            log(f"🔧 升級資料庫結構：stock_info 新增 '{name}' 欄位...")
+            conn.execute(f"ALTER TABLE stock_info ADD COLUMN {name} {decl}")
+            conn.commit()
+
+def init_db(db_path):
+    """建立 (或升級) 市場資料庫的 stock_prices / stock_info / sync_meta"""
+    # ⚠️ 不走 get_conn：其連線一開就切 WAL，新 DB 的頁大小便無法再設定
+    conn = sqlite3.connect(db_path)
+    try:
+        # 頁大小與增量回收模式：新建 DB 直接生效，必須在建表之前設定
+        conn.execute("PRAGMA page_size=8192")
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # WAL 會寫入檔頭並持續生效，必須排在 page_size 之後 (WAL 下無法再改頁大小)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS stock_prices (
+                date TEXT, symbol TEXT, open REAL, high REAL,
+                low REAL, close REAL, volume INTEGER,
+                PRIMARY KEY (date, symbol)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS stock_info (
+                symbol TEXT PRIMARY KEY, name TEXT, sector TEXT,
+                market TEXT, updated_at TEXT, empty_runs INTEGER DEFAULT 0, empty_checked TEXT
+            )
+        """)
+        # 同步狀態 (例如清單完整同步日期)，舊版 DB 開啟時也會補建
+        conn.execute("CREATE TABLE IF NOT EXISTS sync_meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.commit()
+        ensure_info_columns(conn)
+    finally:
+        conn.close()
+
+# ========== 10. 股價同步流程 ==========
+def sync_prices(db_path, items, symbol_map_fn=None, mode="hot", start_date=None, end_date=None,
+                desc="同步", extra_retry=None, max_workers=None, full_vacuum=False):
+    """
+    各市場共用的股價同步流程，下載器只需提供清單：
+    增量起抓日 -> 略過死代號 -> 分批下載與補抓 -> 背景寫入 -> 空資料計數 -> 重建索引 -> 維護。
+    items: [(資料庫代號, 名稱)]
+    symbol_map_fn: 資料庫代號 list -> {yfinance 代號: 資料庫代號}，預設兩者相同
+    extra_retry: 同上，回傳第二輪補抓用的代號對照 (例如港股去掉前導 0)
+    回傳 {"success": 實際寫入成功的檔數, "fail_list": 寫入失敗的代號, "has_changed": 是否有新增或修正的價量}；
+    連線留給呼叫端統計後再 close_conn。
+    """
+    symbol_map_fn = symbol_map_fn or (lambda symbols: {s: s for s in symbols})
+    success_count = 0
+    # 💡 熱模式只補各檔最後日期之後的資料；冷模式重抓完整歷史
+    last_dates = load_last_dates(db_path) if mode == "hot" else {}
+    if not last_dates:
+        # 冷模式或首次建庫 (尚無任何歷史) 都是整批灌入，先移除次要索引
+        defer_symbol_index(db_path)
+    # 💡 連續多次都抓不到資料的代號 (下市/停牌) 熱模式暫時略過 (定期重新探測)，冷模式仍全部重試
+    dead = load_dead_symbols(db_path) if mode == "hot" else set()
+    targets = [it for it in items if it[0] not in dead] if dead else items
+    if dead:
+        log(f"⏭️  略過連續無資料代號: {len(items) - len(targets)} 檔")
+    empty_symbols, fetched_symbols = [], []
+    if last_dates:
+        # 💡 依最後日期排序後再分批：批次起抓日取批內最小值，停牌/下市等進度落後的代號
+        # 集中在同一批，不會把其他 ~50 檔的增量區間一起往前拉 (穩定排序，同日期維持原順序)
+        targets = sorted(targets, key=lambda it: last_dates.get(it[0], ''))
+    batches = [targets[i:i + YF_BATCH_SIZE] for i in range(0, len(targets), YF_BATCH_SIZE)]
+
+    # 💡 每批一次 yfinance 請求 (內建多執行緒)，寫入交給背景執行緒
+    # 進度條以「檔數」計，並限制重繪頻率，降低 CI 日誌的輸出量
+    with PriceWriter(db_path) as writer, \
+         tqdm(total=len(targets), desc=desc, mininterval=0.5,
+              miniters=max(1, len(targets) // 200), smoothing=0.1) as pbar:
+        for batch in batches:
+            symbols = [symbol for symbol, _ in batch]
+            batch_start = incremental_start(symbols, last_dates, start_date)
+            symbol_map = symbol_map_fn(symbols)
+            results = download_batch(symbol_map, batch_start, end_date, threads=max_workers or True)
+            # 批次中缺漏的新代號整批重試一次
+            # (已有歷史的代號在增量區間沒資料屬正常，例如假日或停牌)
+            retry_missing(symbol_map, results, last_dates, batch_start, end_date)
+            if extra_retry:
+                retry_missing(extra_retry(symbols), results, last_dates, batch_start, end_date)
+            # ⚠️ 整批一檔都沒回來多半是請求本身失敗 (限流、解析錯誤)，不能算成各代號沒資料
+            batch_ok = bool(results)
+            drop_known_rows(results, last_dates)
+
+            for symbol in symbols:
+                df_res = results.get(symbol)
+                if df_res is not None:
+                    writer.put(df_res)
+                    success_count += 1
+                    fetched_symbols.append(symbol)
+                elif batch_ok and symbol not in last_dates:
+                    empty_symbols.append(symbol)
+
+            pbar.update(len(symbols))
+
+    # ⚠️ 放進佇列不代表已落盤：寫入/提交失敗的代號從成功數扣除並回報
+    failed = writer.failed_symbols
+    if failed:
+        log(f"❌ 資料庫寫入失敗: {len(failed)} 檔 ({writer.errors} 次錯誤)")
+        fetched_symbols = [s for s in fetched_symbols if s not in failed]
+        success_count = len(fetched_symbols)
+
+    record_empty_runs(db_path, empty_symbols, fetched_symbols)
+    ensure_symbol_index(db_path)
+    maintain_db(get_conn(db_path), full_vacuum=full_vacuum)
+    return {"success": success_count, "fail_list": sorted(failed),
+            "has_changed": writer.rows_written > 0}